@@ -5,8 +5,9 @@ Landis+Gyr Stromzaehler auslesen und an Influx und/oder Graphite
 senden. 
 Der Graphite Part ist auskommentiert (siehe Main)
 
-Die gelesenen Werte werden zunaechst in einen lokalen Redis abgelegt.
-Die Weiterletung an Influx erfolgt in einem seperaten Thread.
+Die gelesenen Werte werden ueber eine Queue an einen seperaten Thread
+uebergeben, der sie an Influx weiterleitet. Werte, die nicht gesendet
+werden konnten, werden im lokalen Redis abgelegt und spaeter nachgesendet.
 
 Der Landis Gyr Stromzaehler liefert im default nur die Werte
 fuer die Zaehlerstaende (Bezug und Einspeisung.)
@@ -19,30 +20,53 @@ von deinem Versorger/Netzbetreiber.
 
 import serial
 import argparse
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import time
 from datetime import datetime
 import redis
 import graphyte
 from smllib  import SmlStreamReader
-from smllib.const import OBIS_NAMES, UNITS
 from hexdump import hexdump
 from threading import Thread
 import influxdb_client, os, time
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+from influxdb_client import InfluxDBClient, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
-import pytz
 
 
 verbose = 0 
 GRAPHITEHOST = 'oel.localdomain'
 INFLUX_INI = 'influx.ini'
 INFLUX_BUCKET = 'Energie'
-TZ =  pytz.timezone('Europe/Berlin')
+INFLUX_BATCH = 500
+INFLUX_INFLIGHT = 2   # max. gleichzeitig laufende Writes
+
+# Gemeinsamer Pool fuer alle Redis Verbindungen, per default TCP auf localhost.
+# Mit --redis-socket wird stattdessen der Unix Socket verwendet.
+REDIS_MAX_CONNECTIONS = 8
+REDIS_POOL = redis.ConnectionPool(host='localhost', max_connections=REDIS_MAX_CONNECTIONS)
+
+INFLUX_Q = queue.Queue(maxsize=10000)   # Werte fuer SendInflux
+INFLUX_Q_TIMEOUT = 60   # Sekunden, die main() bei voller Queue wartet
+UNSENT_MAX = 100000     # max. Werte im Speicher, wenn auch Redis nicht erreichbar ist
 
 OBIS_MAP_GRAPHITE = { '0100010800ff' : 'Verbrauch.total',
                       '0100020800ff' : 'Einspeisung.total',
                       '0100100700ff' : 'Wirkleistung.aktuell' }
+# Fertiger Anfang des Line Protocol pro obis, z.B. 'Strom,Wert=Verbrauch total='
+OBIS_MAP_INFLUX = {obis: 'Strom,Wert={} {}='.format(*name.split('.')) for obis, name in OBIS_MAP_GRAPHITE.items()}
+
+# Faktor fuer den scaler: Wert = value * 10 ** scaler
+SCALE = {i: 10.0 ** i for i in range(-6, 7)}
+
+ESCAPESEQUENCE = b'\x1b\x1b\x1b\x1b'
+STARTSYN = ESCAPESEQUENCE + b'\x01\x01\x01\x01'   # Start einer SML Nachricht
+ENDMSG = ESCAPESEQUENCE + b'\x1a'                   # Ende, danach noch 3 Bytes
+
+buf = bytearray()   # Empfangspuffer fuer read_sml()
+STREAM = SmlStreamReader()   # fuer dosml(), wird fuer alle Nachrichten verwendet
 
 def dump(info, data, cond=True):
     if cond and data:
@@ -61,7 +85,10 @@ def open_serial(device):
 
 def read_sml(ser):
     """Read the next SML transport message from the serial device
-   
+
+    Die gelesenen Bytes werden in einem Puffer (buf) gesammelt, der
+    auch Reste fuer die naechste Nachricht aufnimmt.
+
     Returns
     -------
     bytes
@@ -70,68 +97,70 @@ def read_sml(ser):
         On failure
     """
 
-    sml_frame = None # default result
     max_read = 5 #limit the number of read attemps to avoid endless loop
+    scan = len(STARTSYN)   # ab hier nach dem Ende suchen, bereits durchsuchtes nicht nochmal
 
-    escapeSequence = b'\x1b\x1b\x1b\x1b'
-    startMessage = b'\x01\x01\x01\x01'
-    startSyn = escapeSequence + startMessage
-    endMessageB1 = b'\x1a'
-    endMsg = escapeSequence + endMessageB1
-    start_found = False
-    end_found = False
     # Falls es beim lesen zu timeout kommt. siehe openSerial() timeout 
-    d_start = b""
-    while not start_found and max_read > 0:
-        d_start = ser.read_until(startSyn)
-        dump('d_start', d_start, verbose>=1)
-        if d_start == startSyn:   # Start Sequence am Anfang.
-            start_found = True
-        elif not d_start == startSyn and len(d_start)>8: # Start mittendrin ?
+    while max_read > 0:
+        start = 0 if buf.startswith(STARTSYN) else buf.find(STARTSYN)
+        if start > 0:   # Start mittendrin ?
             if verbose >= 1: print('mittendrin...')
-            if startSyn in d_start:
-                pos = d_start.find(startSyn)
-                d_start = d_start[pos:]
-                start_found = True
+            del buf[:start]
+            start = 0
+            scan = len(STARTSYN)
+        if start == 0:
+            end = buf.find(ENDMSG, scan)
+            if end < 0:
+                # Das Ende kann hoechstens in den letzten Bytes angefangen haben
+                scan = max(len(STARTSYN), len(buf) - len(ENDMSG) + 1)
+            # Nach dem Ende noch 1 Byte count filler. 2 Bytes CRC
+            elif len(buf) >= end + len(ENDMSG) + 3:
+                end += len(ENDMSG) + 3
+                with memoryview(buf) as mv:
+                    sml_frame = bytes(mv[:end])
+                del buf[:end]
+                return sml_frame
             else:
-                print('Was das denn...')
-        else:
+                scan = end
+        elif len(buf) >= len(STARTSYN):
+            # Keine Start Sequence. Nur den Rest behalten, der ein Anfang sein kann.
+            del buf[:1 - len(STARTSYN)]
+
+        data = ser.read(max(1, ser.in_waiting))
+        if verbose >= 1: dump('data', data)
+        if not data:
             print("read timeout")
-        max_read -= 1
-    max_read = 5
-    # Rest ohne timeout ?
-    
-    d_frame = ser.read_until(endMsg)
-    dump('d_frame', d_frame, verbose>=1)
-
-    d_end = ser.read(3)   # 1 Byte count filler. 2 Bytes CRC
-    sml_frame = d_start + d_frame + d_end
-    return sml_frame
+            max_read -= 1
+        buf.extend(data)
+    return None
 
 
 def dosml(data):
-    stream = SmlStreamReader()
-    stream.add(data) 
-    sml_frame = stream.get_frame()
+    STREAM.add(data)
+    sml_frame = STREAM.get_frame()
     if not sml_frame:
         print('Bytes missing')
+        STREAM.clear()   # Rest nicht vor die naechste Nachricht haengen
         return None 
 
     parsed_msgs = sml_frame.parse_frame()
     # In the parsed message the obis values are typically found like this
     obis_values = parsed_msgs[1].message_body.val_list
 
-    ts = datetime.now().timestamp()
+    # Zeitstempel einmal pro SML Nachricht, gilt fuer alle Werte
+    ts = time.time_ns()
+    lookup = OBIS_MAP_INFLUX.get
+    scale = SCALE
     for  list_entry in obis_values:
-        if list_entry.obis in OBIS_NAMES:
-            #print(f'{OBIS_NAMES[list_entry.obis]} - {list_entry.obis} {list_entry.obis.obis_short}: ', end ='')
-            value = str(round(list_entry.value * ( 10 ** list_entry.scaler),1))
-            #print(f'value: {value} {UNITS[list_entry.unit]}')
-            if list_entry.obis in OBIS_MAP_GRAPHITE:
-                graphite_frame = f'Strom.{OBIS_MAP_GRAPHITE[list_entry.obis]} {value} {ts}'
-           #     print (f'graphite_frame: {graphite_frame}')
-           #     print("=" * 80)
-                yield graphite_frame
+        prefix = lookup(list_entry.obis)
+        if prefix is None:
+            continue
+        factor = scale.get(list_entry.scaler)
+        if factor is None:   # scaler ausserhalb der Tabelle
+            factor = 10.0 ** list_entry.scaler
+        # Influx Line Protocol, z.B. Strom,Wert=Verbrauch total=12345.6 1700000000000000000
+        record = f'{prefix}{list_entry.value * factor:.1f} {ts}'
+        yield record
 
         #print(list_entry.obis)            # 0100010800ff
         #print(list_entry.obis.obis_code)  # 1-0:1.8.0*255
@@ -143,25 +172,31 @@ def dosml(data):
 class SendGraphite(Thread):
     def __init__(self):
         Thread.__init__(self)
-        self.redis_con = redis.Redis(host='localhost')
+        self.redis_con = redis.Redis(connection_pool=REDIS_POOL)
         self.graphite_con = graphyte.Sender(GRAPHITEHOST, raise_send_errors=True)
 
     def run(self):
+        brpop = self.redis_con.brpop
+        sendgraphite = self.sendgraphite
+        keys = ['stromwert']
         while True:
-            stromwert = self.redis_con.rpop('stromwert')
-            if not stromwert:
-                time.sleep(1.0)
-            else:
-                stromwert = stromwert.decode()
+            # Blockiert bis ein Wert da ist, kein Pollen mit sleep()
+            item = brpop(keys, timeout=5)
+            if item:
+                stromwert = item[1].decode()
                 #print(f'send graphite: {stromwert}')
-                if not self.sendgraphite(stromwert):
+                if not sendgraphite(stromwert):
                     self.redis_con.rpush('stromwert', stromwert)
                     time.sleep(2)
 
     def sendgraphite(self, stromwert):
-        (metric, value, timestamp) = stromwert.split()
+        # Line Protocol zurueck in den Graphite Pfad, z.B. Strom.Verbrauch.total
+        (series, fieldset, timestamp) = stromwert.split()
+        (messurement, tag) = series.split(',')
+        (field, value) = fieldset.split('=')
+        metric = f"{messurement}.{tag.split('=')[1]}.{field}"
         try:
-            self.graphite_con.send(metric, float(value), float(timestamp))
+            self.graphite_con.send(metric, float(value), int(timestamp) / 1e9)
         except Exception as e:
             print(e)
             return False
@@ -170,82 +205,170 @@ class SendGraphite(Thread):
 
 class SendInflux(Thread):
     def __init__(self, inifile):
-        Thread.__init__(self)
+        Thread.__init__(self, daemon=True)   # main() soll sich bei Fehlern beenden koennen
         self.bucket = INFLUX_BUCKET
-        self.redis_con = redis.Redis(host='localhost')
+        self.backlog = True   # beim Start evtl. liegengebliebene Werte aus Redis nachsenden
+        self.unsent = []      # Werte, die auch nicht in Redis abgelegt werden konnten
+        self.inflight = deque()   # (Future, stromwerte) der laufenden Writes
+        self.redis_con = redis.Redis(connection_pool=REDIS_POOL)
         self.client = influxdb_client.InfluxDBClient.from_config_file(inifile)
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        # Die Writes laufen im Executor: waehrend der POST laeuft
+        # wird schon der naechste Batch gesammelt.
+        self.executor = ThreadPoolExecutor(max_workers=INFLUX_INFLIGHT)
 
     def run(self):
+        get = INFLUX_Q.get
+        get_nowait = INFLUX_Q.get_nowait
+        sendinflux = self.sendinflux
         while True:
-            stromwert = self.redis_con.rpop('stromwertinfluxdb')
-            if not stromwert:
-                time.sleep(1)
-            else:
-                stromwert = stromwert.decode()
-                (metric, value, timestamp) = stromwert.split()
-                (messurement, tagval, field) = metric.split('.')
-
-                ts = datetime.fromtimestamp(float(timestamp)).astimezone(TZ).isoformat()
-                # print(ts, messurement, tagval, field, value)
-                point = (
-                         Point(messurement)
-                         .tag('Wert', tagval)
-                         .field(field, float(value))
-                         .time(ts)
-                         )
-                if not self.sendinflux(point):
-                    self.redis_con.rpush('stromwertinfluxdb', stromwert)
-                    time.sleep(2)
-
-    def sendinflux(self, point):
+            # Blockiert bis ein Wert da ist, danach alle anstehenden mitnehmen
+            stromwerte = [get()]
+            append = stromwerte.append
+            while len(stromwerte) < INFLUX_BATCH:
+                try:
+                    append(get_nowait())
+                except queue.Empty:
+                    break
+            if self.unsent:
+                # Wie beim Redis Backlog hoechstens INFLUX_BATCH auf einmal nachsenden
+                stromwerte = self.unsent[:INFLUX_BATCH] + stromwerte
+                del self.unsent[:INFLUX_BATCH]
+            if self.backlog:
+                # lpush legt vorne an, die aeltesten Werte stehen also hinten
+                parked = self.popoldest('stromwertinfluxdb', INFLUX_BATCH)
+                if parked is not None:
+                    self.backlog = len(parked) == INFLUX_BATCH
+                    stromwerte = [stromwert.decode() for stromwert in reversed(parked)] + stromwerte
+            if not sendinflux(stromwerte):
+                time.sleep(2)
+
+    def popoldest(self, key, count):
+        """Atomically fetch and remove the oldest count entries of a redis list
+
+        Returns None if redis is not reachable.
+        """
+        pipe = self.redis_con.pipeline()
+        pipe.lrange(key, -count, -1)
+        pipe.ltrim(key, 0, -count - 1)
+        try:
+            (stromwerte, _) = pipe.execute()
+        except redis.RedisError as e:
+            print(f'redis: {e}')
+            return None
+        return stromwerte
+
+    def park(self, stromwerte):
+        """Keep unsent values in redis, they are sent with the next batch"""
+        try:
+            self.redis_con.lpush('stromwertinfluxdb', *stromwerte)
+        except redis.RedisError as e:
+            # Dann eben im Speicher halten und mit dem naechsten Batch senden
+            print(f'redis: {e}')
+            self.unsent.extend(stromwerte)
+            if len(self.unsent) > UNSENT_MAX:
+                print(f'dropping {len(self.unsent) - UNSENT_MAX} values')
+                del self.unsent[:-UNSENT_MAX]
+        self.backlog = True
+
+    def sendinflux(self, stromwerte):
+        ok = True
+        # Ergebnisse abholen: alle fertigen, und so viele, dass hoechstens
+        # INFLUX_INFLIGHT Writes gleichzeitig laufen.
+        while self.inflight and (len(self.inflight) >= INFLUX_INFLIGHT or self.inflight[0][0].done()):
+            (future, sent) = self.inflight.popleft()
+            try:
+                future.result()
+            except Exception as e:
+                print(e)
+                self.park(sent)
+                ok = False
         try:
-            #print(f'point: {point}')
-            self.write_api.write(bucket=self.bucket, record=point)
+            #print(f'stromwerte: {stromwerte}')
+            future = self.executor.submit(self.write_api.write, bucket=self.bucket,
+                                          record=stromwerte, write_precision=WritePrecision.NS)
         except Exception as e:
             print(e)
+            self.park(stromwerte)
             return False
-        return True
+        self.inflight.append((future, stromwerte))
+        return ok
+
+def save_pending(sendinflux, unqueued):
+    """Park values not yet sent to Influx in redis before exiting"""
+    queued = []
+    while True:
+        try:
+            queued.append(INFLUX_Q.get_nowait())
+        except queue.Empty:
+            break
+    # Aelteste zuerst, wie bei SendInflux.park()
+    stromwerte = list(sendinflux.unsent) + queued + unqueued
+    if stromwerte:
+        try:
+            redis.Redis(connection_pool=REDIS_POOL).lpush('stromwertinfluxdb', *stromwerte)
+        except redis.RedisError as e:
+            print(f'redis: {e}, {len(stromwerte)} values lost')
 
 ################################ MAIN #################################
 def main():
-    global verbose
+    global verbose, REDIS_POOL
     error = None
 
     parser = argparse.ArgumentParser(description='Read Landis+Gyr E320 electric power meter')
     parser.add_argument('-d', '--device', '--port', required=True, help='name of serial port device, e.g. /dev/ttyUSB0')
     parser.add_argument('-i', '--inifile', required=True, help='Influx Configfile.')
+    parser.add_argument('-s', '--redis-socket', help='connect to redis via unix socket, e.g. /run/redis/redis-server.sock')
     parser.add_argument('-v', '--verbose', action='count', help='verbosity level')
     args = parser.parse_args()
 
     if args.verbose:
         verbose = args.verbose
+    if args.redis_socket:
+        REDIS_POOL = redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+                                          path=args.redis_socket,
+                                          max_connections=REDIS_MAX_CONNECTIONS)
 
     #sendgraphite = SendGraphite()
     #sendgraphite.start()
     sendinflux = SendInflux(inifile=args.inifile)
     sendinflux.start()
 
+    unqueued = []   # Werte, die bei voller Queue nicht mehr uebergeben wurden
     fdser = open_serial(args.device)
     if fdser:
-        redis_con = redis.Redis(host='localhost')
         while True:
+            if not sendinflux.is_alive():
+                error = "ERR_SENDER"
+                break
             smlframe = read_sml(fdser)        
             if smlframe:      
-                dump("SMLTransportMessage", smlframe, verbose >=1)
-                for graphite_frame in dosml(smlframe):
-                    #print(f'lpush redis: {graphite_frame}')
-                    #redis_con.lpush('stromwert', graphite_frame)
-                    redis_con.lpush('stromwertinfluxdb', graphite_frame)
+                if verbose >= 1: dump("SMLTransportMessage", smlframe)
+                records = list(dosml(smlframe))
+                if records:
+                    #print(f'lpush redis: {records}')
+                    #redis.Redis(connection_pool=REDIS_POOL).lpush('stromwert', *records)
+                    for i, record in enumerate(records):
+                        try:
+                            INFLUX_Q.put(record, timeout=INFLUX_Q_TIMEOUT)
+                        except queue.Full:
+                            unqueued = records[i:]
+                            break
+                    if unqueued:
+                        # SendInflux haengt: beenden, damit systemd neu startet
+                        error = "ERR_QUEUE"
+                        break
             else:
                 error = "ERR_MESG"
     else:
         error = "ERR_DEVICE"
 
-    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
 
     if error:
         print(now, error)
+        save_pending(sendinflux, unqueued)
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()